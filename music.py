@@ -1,13 +1,26 @@
+import asyncio
+import io
 import os
+import re
+from urllib.parse import urlparse, parse_qs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import yt_dlp
 import streamlit as st
-import base64
+import binascii
 import hashlib
-import tempfile
+import shelve
+import dbm
 from dotenv import load_dotenv
-import json
-from rich.console import Console
+import orjson
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,67 +29,251 @@ load_dotenv()
 API_KEY = os.getenv('MINIMAX_API_KEY')
 UPLOAD_API_URL = 'https://api.minimax.chat/v1/music_upload'
 MUSIC_GENERATION_API_URL = 'https://api.minimax.chat/v1/music_generation'
-
-# Initialize a Rich console for prettier output
-console = Console()
+HEX_CHUNK_SIZE = 1 << 16  # Hex characters decoded per write
+STREAM_READ_SIZE = 1 << 16  # Bytes read per chunk from streamed generation responses
+# Hex audio never contains quotes, so this only matches the frame's own data.status field
+FINAL_FRAME_STATUS = re.compile(rb'"status"\s*:\s*2\b')
+FRAME_AUDIO_KEY = re.compile(rb'"audio"\s*:\s*"')
+UPLOAD_CACHE_PATH = os.path.expanduser('~/.cache/music/ids.db')
+UPLOAD_ID_KEYS = {'voice': 'voice_id', 'song': 'instrumental_id'}
+AUDIO_MIME_TYPES = {
+    'mp3': 'audio/mpeg',
+    'm4a': 'audio/mp4',
+    'webm': 'audio/webm',
+    'opus': 'audio/ogg',
+    'ogg': 'audio/ogg',
+    'wav': 'audio/wav',
+}
 
 # Helper Functions
-@st.cache_data
+def _canonical_yt(url):
+    """
+    Reduces a YouTube URL to https://youtu.be/<id>, dropping tracking and timestamp params.
+    Unrecognized URLs are returned unchanged.
+    """
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith(('www.', 'm.')):
+        host = host.split('.', 1)[1]
+    video_id = None
+    if host == 'youtu.be':
+        video_id = parsed.path.lstrip('/').split('/')[0]
+    elif host in ('youtube.com', 'music.youtube.com'):
+        if parsed.path == '/watch':
+            video_id = parse_qs(parsed.query).get('v', [None])[0]
+        elif parsed.path.startswith(('/shorts/', '/embed/', '/live/')):
+            video_id = parsed.path.split('/')[2]
+    return f"https://youtu.be/{video_id}" if video_id else url
+
 def download_audio_from_youtube(url, purpose):
     """
-    Downloads audio from YouTube and converts it to MP3 format.
+    Downloads audio from YouTube, normalizing the URL so equivalent links share a cache entry.
+    """
+    return _download_audio(_canonical_yt(url), purpose)
+
+_idle_ydls = {}
+_idle_ydls_lock = threading.Lock()
+
+def _ydl_pool(purpose):
+    """
+    Returns the queue of idle YoutubeDL instances for a purpose.
+    YoutubeDL is not thread-safe, so each download checks one out exclusively and returns it
+    afterwards; concurrent downloads build extra instances instead of waiting on each other.
+    """
+    with _idle_ydls_lock:
+        return _idle_ydls.setdefault(purpose, queue.SimpleQueue())
+
+def _build_ydl(purpose):
+    """
+    Builds a YoutubeDL instance that writes <purpose>_<video id>.<ext> audio files.
+    """
+    return yt_dlp.YoutubeDL({
+        'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio',
+        'outtmpl': f'{purpose}_%(id)s.%(ext)s',
+        # 'best' copies AAC/Opus streams as-is; other codecs fall back to a VBR MP3 encode
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'best',
+            'preferredquality': '4',
+        }],
+    })
+
+@st.cache_data
+def _download_audio(url, purpose):
+    """
+    Downloads the best audio stream from YouTube, preferring containers that need no re-encode.
     """
     try:
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'outtmpl': f'{purpose}_%(title).50s.%(ext)s',
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        pool = _ydl_pool(purpose)
+        try:
+            ydl = pool.get_nowait()
+        except queue.Empty:
+            ydl = _build_ydl(purpose)
+        try:
             info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info).replace('.webm', '.mp3').replace('.m4a', '.mp3')
-        
-        # Handle long filenames by hashing
-        if len(filename) > 200:
-            hash_object = hashlib.md5(filename.encode())
-            new_filename = f"{purpose}_{hash_object.hexdigest()}.mp3"
-            os.rename(filename, new_filename)
-            filename = new_filename
-        
-        return filename
+        finally:
+            pool.put(ydl)
+        # The extract-audio step may change the extension (e.g. webm -> opus), so use the final path
+        return info['requested_downloads'][0]['filepath']
     except Exception as e:
         st.error(f"Error downloading audio from YouTube: {e}")
         return None
 
+def _attach_script_ctx(ctx):
+    """
+    Attaches the Streamlit script context to the current worker thread so st.* calls render.
+    """
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+async def run_with_status(coro, label):
+    """
+    Awaits a coroutine while ticking the elapsed time on an st.status box.
+    """
+    task = asyncio.ensure_future(coro)
+    started = time.monotonic()
+    with st.status(label) as status:
+        while not task.done():
+            await asyncio.wait({task}, timeout=1)
+            status.update(label=f"{label} ({int(time.monotonic() - started)}s)")
+        result = task.result()
+        status.update(state="complete" if result else "error")
+    return result
+
+def iter_sse_lines(response):
+    """
+    Yields lines from a streamed response in linear time.
+    requests' iter_lines re-concatenates the pending line on every read, which is
+    quadratic for the multi-megabyte single-line frames the generation API sends.
+    """
+    pending = bytearray()
+    for chunk in response.iter_content(STREAM_READ_SIZE):
+        # Bytes already pending hold no newline, so only the new chunk needs scanning
+        search_from = len(pending)
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b'\n', search_from)
+            if end == -1:
+                break
+            yield bytes(pending[start:end]).rstrip(b'\r')
+            start = search_from = end + 1
+        del pending[:start]
+    if pending:
+        yield bytes(pending).rstrip(b'\r')
+
+def frame_audio(frame):
+    """
+    Returns a memoryview over the hex data.audio value of a raw SSE frame, or None.
+    Hex has no quotes or escapes, so the value ends at the next quote and the frame
+    never needs to be parsed into a str.
+    """
+    match = FRAME_AUDIO_KEY.search(frame)
+    if not match:
+        return None
+    end = frame.find(b'"', match.end())
+    if end == -1:
+        return None
+    return memoryview(frame)[match.end():end]
+
+def write_hex_audio(sink, audio_data):
+    """
+    Decodes hex-encoded audio in chunks and writes it to a binary file object.
+    """
+    for i in range(0, len(audio_data), HEX_CHUNK_SIZE):
+        sink.write(binascii.unhexlify(audio_data[i:i + HEX_CHUNK_SIZE]))
+
+def file_sha256(file_path):
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# shelve is not safe for concurrent access, so serialize it across worker threads
+_upload_cache_lock = threading.Lock()
+
+def _read_upload_cache(cache_key):
+    """
+    Returns a cached upload result, or None if it is missing or the cache is unusable.
+    """
+    try:
+        with _upload_cache_lock:
+            os.makedirs(os.path.dirname(UPLOAD_CACHE_PATH), exist_ok=True)
+            with shelve.open(UPLOAD_CACHE_PATH) as cache:
+                return cache.get(cache_key)
+    except (OSError, *dbm.error):
+        return None
+
+def _write_upload_cache(cache_key, result):
+    """
+    Stores an upload result; cache failures are ignored since the upload itself succeeded.
+    """
+    try:
+        with _upload_cache_lock:
+            with shelve.open(UPLOAD_CACHE_PATH) as cache:
+                cache[cache_key] = result
+    except (OSError, *dbm.error):
+        pass
+
 class MusicProcessor:
     def __init__(self, api_key):
         self.api_key = api_key
-        self.headers = {'Authorization': f'Bearer {self.api_key}'}
+        # Pooled session so upload and generation reuse the same HTTPS connection
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'Bearer {self.api_key}'})
+        # Only retry failed connection attempts: every call is a POST, and replaying a
+        # generation request after a 5xx could bill twice, so status retries stay off
+        retries = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.3)
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
     
     def upload_audio(self, file_path, purpose):
         """
         Uploads an audio file to the Upload API.
+        Results are cached on disk by file content so identical audio is only uploaded once.
         """
+        # IDs belong to the uploading Minimax account, so scope entries to a hash of the API key
+        account = hashlib.sha256(str(self.api_key).encode()).hexdigest()[:16]
+        cache_key = f"{account}:{purpose}:{file_sha256(file_path)}"
+        cached = _read_upload_cache(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             with open(file_path, 'rb') as f:
-                files = {'file': f}
-                data = {'purpose': purpose}
-                response = requests.post(UPLOAD_API_URL, headers=self.headers, data=data, files=files, timeout=30)
+                # Stream the multipart body from disk instead of buffering the whole file
+                ext = os.path.splitext(file_path)[1].lstrip('.').lower()
+                encoder = MultipartEncoder(fields={
+                    'purpose': purpose,
+                    'file': (os.path.basename(file_path), f, AUDIO_MIME_TYPES.get(ext, 'application/octet-stream')),
+                })
+                response = self.session.post(UPLOAD_API_URL, data=encoder, headers={'Content-Type': encoder.content_type}, timeout=30)
                 response.raise_for_status()
                 result = response.json()
-                return result
+            
+            # Only cache successful uploads that actually returned an ID
+            if result.get(UPLOAD_ID_KEYS.get(purpose, f'{purpose}_id')):
+                _write_upload_cache(cache_key, result)
+            return result
         except requests.exceptions.RequestException as e:
             st.error(f"Error uploading {purpose} audio file: {e}")
         return None
     
-    def generate_music(self, refer_voice, refer_instrumental, lyrics, model='music-01', stream=False, audio_setting=None):
+    def download_and_upload(self, url, download_purpose, upload_purpose):
+        """
+        Downloads audio from YouTube and uploads it, returning the upload API result.
+        """
+        file_path = download_audio_from_youtube(url, download_purpose)
+        if not file_path:
+            return None
+        return self.upload_audio(file_path, upload_purpose)
+    
+    def generate_music(self, sink, refer_voice, refer_instrumental, lyrics, model='music-01', stream=False, audio_setting=None):
         """
         Generates AI music based on provided voice and instrumental references, and lyrics.
+        The decoded audio is written to the binary file object `sink`.
         """
         try:
             if not lyrics:
@@ -99,46 +296,87 @@ class MusicProcessor:
                 'audio_setting': audio_setting
             }
             
-            response = requests.post(MUSIC_GENERATION_API_URL, headers=self.headers, json=payload, timeout=60)
-            response.raise_for_status()
-            result = response.json()
-            
-            if 'data' in result and 'audio' in result['data'] and result['data']['audio']:
-                audio_data = result['data']['audio']
-                try:
-                    audio_bytes = bytes.fromhex(audio_data)
-                    return audio_bytes
-                except Exception as e:
-                    st.error(f"Error converting audio data: {e}")
-            else:
-                st.error(f"Audio data not found in API response")
+            # ACCEPT_ENCODING advertises every codec urllib3 can decode here (zstd when zstandard is installed)
+            headers = {'Content-Type': 'application/json', 'Accept-Encoding': ACCEPT_ENCODING}
+            response = self.session.post(MUSIC_GENERATION_API_URL, data=orjson.dumps(payload), headers=headers, stream=stream, timeout=60)
+            try:
+                response.raise_for_status()
+                if stream:
+                    wrote_audio = False
+                    status_msg = None
+                    # Each server-sent event carries a hex fragment of the song; event:, id:,
+                    # retry: and keep-alive lines carry no JSON and are skipped
+                    for line in iter_sse_lines(response):
+                        if not line.startswith(b'data:'):
+                            continue
+                        # The final event (status 2) repeats the full song; drop it unparsed once fragments have arrived
+                        if wrote_audio and FINAL_FRAME_STATUS.search(line):
+                            continue
+                        audio = frame_audio(line)
+                        if audio:
+                            write_hex_audio(sink, audio)
+                            wrote_audio = True
+                            continue
+                        # Frames without audio are small, so parse them for the API status
+                        event_data = line[len(b'data:'):].strip()
+                        if not event_data:
+                            continue
+                        base_resp = orjson.loads(event_data).get('base_resp') or {}
+                        if base_resp.get('status_code'):
+                            status_msg = base_resp.get('status_msg')
+                    if wrote_audio:
+                        return True
+                    if status_msg:
+                        st.error(f"Audio data not found in API response: {status_msg}")
+                    else:
+                        st.error(f"Audio data not found in API response")
+                else:
+                    result = orjson.loads(response.content)
+                    if 'data' in result and 'audio' in result['data'] and result['data']['audio']:
+                        write_hex_audio(sink, result['data']['audio'])
+                        return True
+                    st.error(f"Audio data not found in API response")
+            finally:
+                response.close()
         except requests.exceptions.RequestException as e:
             st.error(f"Error generating music: {e}")
+        except ValueError as e:
+            st.error(f"Error converting audio data: {e}")
         return None
 
-def format_lyrics_for_minimax(lyrics):
+    async def generate_music_async(self, *args, **kwargs):
+        """
+        Runs generate_music in a worker thread so the Streamlit script can keep updating the UI.
+        """
+        ctx = get_script_run_ctx()
+        def run():
+            _attach_script_ctx(ctx)
+            return self.generate_music(*args, **kwargs)
+        return await asyncio.to_thread(run)
+
+@st.cache_resource
+def get_processor(api_key):
     """
-    Formats the lyrics according to Minimax Music Creation API requirements.
+    Returns a MusicProcessor shared across reruns so its connection pool survives.
     """
-    lines = lyrics.strip().split('\n')
-    formatted = "##" + "\n".join(line.strip() for line in lines if line.strip()) + "##"
-    return formatted
+    return MusicProcessor(api_key)
 
-def get_binary_file_downloader_html(bin_file, file_label='File'):
+@st.cache_data(ttl=3600)
+def format_lyrics_for_minimax(lyrics):
     """
-    Generates a download link for a binary file.
+    Formats the lyrics according to Minimax Music Creation API requirements.
     """
-    with open(bin_file, 'rb') as f:
-        data = f.read()
-    bin_str = base64.b64encode(data).decode()
-    href = f'<a href="data:audio/mp3;base64,{bin_str}" download="{os.path.basename(bin_file)}">Download {file_label}</a>'
-    return href
+    buf = io.StringIO()
+    buf.write("##")
+    buf.write("\n".join(filter(None, (line.strip() for line in lyrics.splitlines()))))
+    buf.write("##")
+    return buf.getvalue()
 
 # Streamlit App
 def main():
     st.title("AI Music Cover Creator")
     
-    music_processor = MusicProcessor(API_KEY)
+    music_processor = get_processor(API_KEY)
     
     # Initialize session state
     if 'step' not in st.session_state:
@@ -177,6 +415,34 @@ def main():
                             st.session_state.voice_id = voice_id
                             st.success(f"Obtained voice_id: {voice_id}")
                             st.session_state.step = 2
+            
+            instrumental_url = st.text_input("Enter YouTube URL for Instrumental (URL 2)", "https://www.youtube.com/watch?v=xxxxxxx")
+            if st.button("Process Vocals and Instrumental Together"):
+                with st.spinner("Processing Vocals and Instrumental..."):
+                    # Each worker checks out its own YoutubeDL instance, so the two downloads run in parallel
+                    with ThreadPoolExecutor(max_workers=2, initializer=_attach_script_ctx, initargs=(get_script_run_ctx(),)) as executor:
+                        voice_future = executor.submit(music_processor.download_and_upload, youtube_url, "voice", "voice")
+                        song_future = executor.submit(music_processor.download_and_upload, instrumental_url, "instrumental", "song")
+                        voice_upload = voice_future.result()
+                        song_upload = song_future.result()
+                
+                voice_id = voice_upload.get('voice_id') if voice_upload else None
+                instrumental_id = song_upload.get('instrumental_id') if song_upload else None
+                if voice_id:
+                    st.session_state.voice_id = voice_id
+                    st.success(f"Obtained voice_id: {voice_id}")
+                else:
+                    st.error("Failed to extract and upload vocals.")
+                if instrumental_id:
+                    st.session_state.instrumental_id = instrumental_id
+                    st.success(f"Obtained instrumental_id: {instrumental_id}")
+                else:
+                    st.error("Failed to upload instrumental as song.")
+                
+                if voice_id and instrumental_id:
+                    st.session_state.step = 3  # Skip to step 3
+                elif voice_id:
+                    st.session_state.step = 2  # Retry the instrumental on its own
         
         if st.button("Next Step"):
             st.session_state.step += 1
@@ -219,26 +485,32 @@ And I know you feel it too"""
         mixer_balance = st.selectbox("Mixer Balance", ("left", "center", "right"))
         output_format = st.selectbox("Output Format", ("mp3", "wav"))
         if st.button("Generate AI Cover"):
-            with st.spinner("Generating AI Cover..."):
-                formatted_lyrics = format_lyrics_for_minimax(lyrics)
-                audio_bytes = music_processor.generate_music(
+            formatted_lyrics = format_lyrics_for_minimax(lyrics)
+            audio_buffer = io.BytesIO()
+            generated = asyncio.run(run_with_status(
+                music_processor.generate_music_async(
+                    audio_buffer,
                     refer_voice=st.session_state.voice_id,
                     refer_instrumental=st.session_state.instrumental_id,
                     lyrics=formatted_lyrics,
                     model='music-01',
-                    stream=False
+                    stream=True
+                ),
+                "Generating AI Cover..."
+            ))
+            
+            if generated:
+                audio_bytes = audio_buffer.getvalue()
+                st.audio(audio_bytes, format=f'audio/{output_format}')
+                st.download_button(
+                    "Download AI Cover",
+                    data=audio_bytes,
+                    file_name=f'ai_cover.{output_format}',
+                    mime=f'audio/{output_format}'
                 )
-                
-                if audio_bytes:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{output_format}') as tmp:
-                        tmp.write(audio_bytes)
-                        tmp_path = tmp.name
-                    
-                    st.audio(tmp_path, format=f'audio/{output_format}')
-                    st.markdown(get_binary_file_downloader_html(tmp_path, 'AI Cover'), unsafe_allow_html=True)
-                    st.success("AI Cover generated successfully!")
-                else:
-                    st.error("Failed to generate AI Cover.")
+                st.success("AI Cover generated successfully!")
+            else:
+                st.error("Failed to generate AI Cover.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file